@@ -1,13 +1,92 @@
 import os
+import queue
+import re
 import sys
+import threading
+import time
 
 from ipykernel.kernelbase import Kernel
 from mpremote.main import State
 from mpremote.transport import TransportError
+from serial.serialutil import SerialException
 
 from .magic import CELL_MAGIC, LINE_MAGIC
 
 
+class PrintIO:
+    """Buffered stream: collects writes and sends them as one iopub message
+    when the buffer is full, on newline once it holds a few hundred bytes,
+    on flush(), or at the latest FLUSH_INTERVAL seconds after a write."""
+
+    BUFFER_SIZE = 4096
+    LINE_SIZE = 256
+    FLUSH_INTERVAL = 0.05
+
+    def __init__(self, kernel, stream="stdout"):
+        self.kernel = kernel
+        self.stream = stream
+        self.buffer = self  # for mpremote
+        self._parts = []
+        self._size = 0
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        if self.stream == "stderr":
+            # keep stdout and stderr in order
+            sys.stdout.flush()
+        with self._lock:
+            self._parts.append(data)
+            self._size += len(data)
+            if self.stream == "stderr" or self._size >= self.BUFFER_SIZE:
+                self.flush()
+            elif "\n" in data and self._size > self.LINE_SIZE:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._parts:
+                return
+            stream_content = {
+                "name": self.stream,
+                "text": "".join(self._parts),
+            }
+            self._parts = []
+            self._size = 0
+            self.kernel.send_response(self.kernel.iopub_socket, "stream", stream_content)
+
+    def isatty(self):
+        return False
+
+
+# control characters interpreted by MpKernel.data_consumer
+_MARKERS = re.compile("([\x1d\x1e])")
+
+# lines that remote_magic dispatches to the host rather than the device
+_LINE_MAGIC = re.compile(r"^\s*[%!]", re.M)
+
+
+def _isolate(body):
+    # run body on the device in its own compile/exec, reporting its errors
+    # between \x1d markers so that data_consumer sends them to stderr
+    return (
+        f"try:\n    exec({repr(body.strip())})\n"
+        "except Exception as _e:\n    import sys\n"
+        "    print('\\x1d', end='')\n"
+        "    sys.print_exception(_e)\n"
+        "    print('\\x1d', end='')"
+    )
+
+
 class MpKernel(Kernel):
     implementation = "MpKernel"
     implementation_version = "1.0"
@@ -27,16 +106,26 @@ class MpKernel(Kernel):
         super().__init__(*args, **kwargs)
         self.state = State()
         self.state._auto_soft_reset = False
+        # (queue, data_consumer) of an exec_remote(wait=False) not yet synced
+        self._pending = None
+        # (code, queue) jobs for the follow thread, started on first use
+        self._jobs = queue.Queue()
+        self._follow_thread = None
+        # data_consumer is between \x1d markers (device traceback -> stderr)
+        self._remote_stderr = False
+        self.redirect_stdout_stderr()
         if os.getenv("MP_LOCAL_WORKING_DIR") is not None:
             os.chdir(os.getenv("MP_LOCAL_WORKING_DIR"))  # type: ignore
 
     def do_execute(  # type: ignore
         self, code, silent, store_history=True, user_expressions=None, allow_stdin=False
     ):
+        # no-op unless something replaced the streams since the last cell
         self.redirect_stdout_stderr()
+        self._remote_stderr = False
         # split code into cells
         code = "remote\n" + code  # remote is the default environment
-        cells = code.strip().split("\n%%")
+        cells = self.coalesce_remote(code.strip().split("\n%%"))
         for cell in cells:
             head, _, code = cell.partition("\n")
             magic, args = (head + " ").split(" ", 1)
@@ -45,12 +134,19 @@ class MpKernel(Kernel):
                 print(f"Unknown cell magic: %%{magic}", file=sys.stderr)
             else:
                 try:
-                    res = method[0](self, args, code)
+                    try:
+                        res = method[0](self, args, code)
+                    finally:
+                        # deliver output and errors of exec_remote(wait=False),
+                        # also if the magic failed after submitting code
+                        self.sync()
                     if res:
+                        sys.stdout.flush()
                         return res
                 except Exception as e:
                     print(f"Error executing cell magic {args}: {e}", file=sys.stderr)
 
+        sys.stdout.flush()
         return {
             "status": "ok",
             "execution_count": self.execution_count,
@@ -58,27 +154,127 @@ class MpKernel(Kernel):
             "user_expressions": {},
         }
 
-    def exec_remote(self, code, *, silent=False, data_consumer=None):
-        """Execute the given code on the remote device."""
+    @staticmethod
+    def coalesce_remote(cells):
+        """Merge consecutive %%remote cells into one, so that they are submitted
+        to the raw REPL together. A \\x1e separator printed between the cells
+        lets data_consumer emit each cell's output as its own stream message.
+
+        Each merged body is compiled and run separately on the device, so a
+        syntax or runtime error only affects its own cell. Cells containing
+        line magics (%... or !...) are not merged, since remote_magic must
+        split those out on the host."""
+        merged = []
+        group = []  # bodies of consecutive mergeable %%remote cells
+
+        def flush():
+            if len(group) == 1:
+                merged.append("remote\n" + group[0])
+            elif group:
+                sep = "\nprint('\\x1e')\n"
+                merged.append("remote\n" + sep.join(_isolate(b) for b in group))
+            group.clear()
+
+        for cell in cells:
+            head, _, body = cell.partition("\n")
+            if head.strip() == "remote" and not _LINE_MAGIC.search(body):
+                if body.strip():
+                    group.append(body)
+                continue
+            flush()
+            merged.append(cell)
+        flush()
+        return merged
+
+    def exec_remote(self, code, *, silent=False, data_consumer=None, wait=True):
+        """Execute the given code on the remote device.
+
+        With wait=False, return as soon as the code is submitted. Output is
+        collected on a background thread and delivered by the next call to
+        exec_remote or sync, so host work can overlap with serial IO."""
         code = code.strip()
         if len(code) == 0:
             return
+        self.sync()
         set_time = self.state.transport is None
         self.state.ensure_raw_repl(soft_reset=False)
         if set_time:
             # always sync clock (e.g. for file modification times)
             rtc.sync_time(self)
         self.state.did_action()
+        data_consumer = None if silent else data_consumer or self.data_consumer
+        if wait:
+            try:
+                self.state.transport.exec_raw_no_follow(code)  # type: ignore
+                _, err = self.state.transport.follow(  # type: ignore
+                    timeout=None, data_consumer=data_consumer
+                )
+                if len(err) > 0:
+                    print(err.decode().strip(), file=sys.stderr)
+            except TransportError as e:
+                print(str(e), file=sys.stderr)
+        else:
+            if self._follow_thread is None:
+                self._follow_thread = threading.Thread(target=self._follow, daemon=True)
+                self._follow_thread.start()
+            q = queue.Queue()
+            self._pending = (q, data_consumer)
+            self._jobs.put((code, q))
+
+    def _follow(self):
+        # runs on the follow thread: never print here, queue (data, err) instead
+        while True:
+            code, q = self._jobs.get()
+            self._follow_one(code, q)
+
+    def _follow_one(self, code, q):
         try:
             self.state.transport.exec_raw_no_follow(code)  # type: ignore
             _, err = self.state.transport.follow(  # type: ignore
-                timeout=None,
-                data_consumer=None if silent else data_consumer or self.data_consumer,
+                timeout=None, data_consumer=lambda data: q.put((data, None))
             )
-            if len(err) > 0:
-                print(err.decode().strip(), file=sys.stderr)
-        except TransportError as e:
-            print(str(e), file=sys.stderr)
+            q.put((None, err))
+        except BaseException as e:
+            q.put((None, e))
+        finally:
+            q.put(None)
+
+    def sync(self):
+        """Wait for a pending exec_remote(wait=False) and deliver its output."""
+        if self._pending is None:
+            return
+        q, data_consumer = self._pending
+        error = None
+        try:
+            while (item := q.get()) is not None:
+                data, err = item
+                if data and data_consumer:
+                    data_consumer(data)
+                if err:
+                    error = err
+        except KeyboardInterrupt:
+            # interrupt the device so that follow returns, and wait for it
+            # before anyone else touches the transport
+            try:
+                self.state.transport.serial.write(b"\x03")  # type: ignore
+            except Exception:
+                pass
+            while q.get() is not None:
+                pass
+            self._pending = None
+            raise
+        # only now is the transport free again
+        self._pending = None
+        if isinstance(error, SerialException):
+            # same as remote_magic: forget the port, give the device time to reboot
+            self.state.transport = None
+            time.sleep(1)
+        elif isinstance(error, TransportError):
+            print(str(error), file=sys.stderr)
+        elif isinstance(error, BaseException):
+            raise error
+        elif error:
+            print(error.decode().strip(), file=sys.stderr)
 
     def data_consumer(self, data):
         if not data:
@@ -89,37 +285,22 @@ class MpKernel(Kernel):
             except UnicodeDecodeError:
                 pass
         data = data.replace("\x04", "")  # type: ignore
-        if data:
-            print(data, end="")
+        # \x1e separates the output of coalesced %%remote cells,
+        # \x1d brackets tracebacks that belong on stderr
+        for part in _MARKERS.split(data):  # type: ignore
+            if part == "\x1e":
+                sys.stdout.flush()
+            elif part == "\x1d":
+                self._remote_stderr = not self._remote_stderr
+            elif part:
+                print(part, end="", file=sys.stderr if self._remote_stderr else None)
 
     def redirect_stdout_stderr(self):
         # print crashes kernel, so we just redirect
-
-        class PrintIO:
-            def __init__(self, kernel, stream="stdout"):
-                self.kernel = kernel
-                self.stream = stream
-                self.buffer = self  # for mpremote
-
-            def write(self, data):
-                if isinstance(data, bytes):
-                    data = data.decode()
-                stream_content = {
-                    "name": self.stream,
-                    "text": data,
-                }
-                self.kernel.send_response(
-                    self.kernel.iopub_socket, "stream", stream_content
-                )
-
-            def flush(self):
-                pass
-
-            def isatty(self):
-                return False
-
-        sys.stdout = PrintIO(self)
-        sys.stderr = PrintIO(self, "stderr")
+        if not isinstance(sys.stdout, PrintIO):
+            sys.stdout = PrintIO(self)
+        if not isinstance(sys.stderr, PrintIO):
+            sys.stderr = PrintIO(self, "stderr")
 
 
 # import everything to include in CELL_MAGIC and LINE_MAGIC
@@ -1,13 +1,19 @@
 import argparse
 import shlex
 from collections import OrderedDict
-from functools import wraps
+from functools import lru_cache, wraps
 
 # dictionaries of handlers name --> (method, descripion)
 LINE_MAGIC = OrderedDict()
 CELL_MAGIC = OrderedDict()
 
 
+# parsers are built once at decoration time; also cache tokenizing the line
+@lru_cache(maxsize=256)
+def _split(line):
+    return tuple(shlex.split(line))
+
+
 # @cell_magic decorator, use last (after all @arg's)
 def cell_magic(fn):
     # function that is called when invoking the magic
@@ -16,7 +22,7 @@ def cell_magic(fn):
         args = None
         try:
             # parse line
-            args = wrapped.parser.parse_args(shlex.split(line))  # type: ignore
+            args = wrapped.parser.parse_args(_split(line))  # type: ignore
         except SystemExit:
             pass
         if args:
@@ -51,7 +57,7 @@ def line_magic(fn):
         args = None
         try:
             # parse line
-            args = wrapped.parser.parse_args(shlex.split(line))  # type: ignore
+            args = wrapped.parser.parse_args(_split(line))  # type: ignore
         except SystemExit:
             pass
         if args:
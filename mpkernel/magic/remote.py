@@ -31,6 +31,8 @@ def line_magic(kernel: MpKernel, line):
     rest = (rest or "").strip()
     method = LINE_MAGIC.get(name)
     if method:
+        # some magics (e.g. %fs) use the transport directly
+        kernel.sync()
         method[0](kernel, rest)
     else:
         print(f"Line magic %{name} not defined", file=sys.stderr)
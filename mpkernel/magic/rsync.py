@@ -1,13 +1,26 @@
-import datetime
+import fnmatch
+import json
 import os
-from fnmatch import fnmatch
+import queue
+import re
+import stat
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 from colored import Fore, Style
 
 from ..kernel import MpKernel
-from ..remote_ops import fput, remote_list, rm_rf
+from ..remote_ops import fput_batch, fput_bytes, remote_list, rm_rf_batch
 from . import arg, line_magic
 
+# files smaller than this are uploaded together, up to BATCH_SIZE bytes of
+# script per batch (the device compiles repr(data), up to 4x the file size)
+SMALL_FILE_SIZE = 4096
+BATCH_SIZE = 16 * 1024
+
 
 @arg(
     "-l",
@@ -54,21 +67,22 @@ def rlist_magic(kernel: MpKernel, args):
         exclude=args.exclude,
         kernel=kernel,
     )
+    levels = {param["level"] for param in files.files.values()}
+    indents = {level: "    " * level for level in levels}
+    green, cyan, reset = Fore.green, Fore.cyan, Style.reset
+    blank = " " * 28
+    rows = []
     for path, param in files.files.items():
         path = os.path.basename(path)
-        mtime = (
-            datetime.datetime.fromtimestamp(param["mtime"], datetime.UTC)
-            .astimezone()
-            .strftime("%Y-%m-%d %H:%M:%S")
-        )
-        level = param["level"]
+        indent = indents[param["level"]]
         if param["is_dir"]:
-            print(f"{' ':7}  {' ':18}  {'    '*level} {Fore.green}{path}/")
+            rows.append(f"{blank} {indent} {green}{path}/{reset}")
         else:
-            print(
-                f"{int(param['size']):7}  {mtime:18} {'    '*level} {Fore.cyan}{path}"
-            )
-        print(Style.reset, end="")
+            # time.strftime is considerably faster than datetime formatting
+            mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(param["mtime"]))
+            rows.append(f"{param['size']:7}  {mtime} {indent} {cyan}{path}{reset}")
+    if rows:
+        sys.stdout.write("\n".join(rows) + "\n")
 
 
 @arg(
@@ -134,6 +148,7 @@ def rsync_magic(kernel: MpKernel, args):
         include=args.include,
         exclude=args.exclude,
         kernel=kernel,
+        crc=True,
     ).files
 
     # compute differences
@@ -142,6 +157,7 @@ def rsync_magic(kernel: MpKernel, args):
     to_del = sorted(rk - lk)
     to_add = sorted(lk - rk)
     to_upd = set()
+    crc_cache = CrcCache()
     for u in rk & lk:
         # update?
         rf = remote_files[u]
@@ -152,9 +168,15 @@ def rsync_magic(kernel: MpKernel, args):
             rf["is_dir"] != lf["is_dir"]
             or rf["level"] != lf["level"]
             or rf["size"] != lf["size"]
-            or rf["mtime"] < lf["mtime"]
         ):
             to_upd.add(u)
+        elif rf["crc"] is not None:
+            # mtime is unreliable (e.g. RTC drift), compare contents
+            if rf["crc"] != crc_cache.crc(os.path.join(lf["abs_path"], u), lf):
+                to_upd.add(u)
+        elif rf["mtime"] < lf["mtime"]:
+            to_upd.add(u)
+    crc_cache.save()
     to_upd = sorted(to_upd)
 
     if len(to_del) + len(to_add) + len(to_upd) == 0:
@@ -165,30 +187,104 @@ def rsync_magic(kernel: MpKernel, args):
         print(f"{Fore.red}Delete")
         for f in to_del:
             print(f"  {f}")
-            if not args.dry_run and not args.upload_only:
-                rm_rf(kernel, f)
+        if not args.dry_run and not args.upload_only:
+            # rm_rf of a directory also removes its contents
+            dirs = {f for f in to_del if remote_files[f]["is_dir"]}
+            paths = [
+                os.path.join(args.remote_path, f)
+                for f in to_del
+                if not any(d in dirs for d in _ancestors(f))
+            ]
+            rm_rf_batch(kernel, paths, batch_size=BATCH_SIZE)
 
     if len(to_add) > 0:
         print(f"{Fore.green}Add")
-        for f in to_add:
-            print(f"  {f}")
-            if not args.dry_run and not local_files[f]["is_dir"]:
-                src = os.path.join(local_files[f]["abs_path"], f)
-                dst = os.path.join(args.remote_path, f)
-                fput(kernel, src, dst)
+        jobs = [
+            (f, None if local_files[f]["is_dir"] else local_files[f]["abs_path"])
+            for f in to_add
+        ]
+        _upload(kernel, args, jobs)
 
     if len(to_upd) > 0:
         print(f"{Fore.cyan}Update")
-        for f in to_upd:
-            print(f"  {f}")
-            if not args.dry_run:
-                src = os.path.join(local_files[f]["abs_path"], f)
-                dst = os.path.join(args.remote_path[0], f)
-                fput(kernel, src, dst)
+        jobs = [(f, local_files[f]["abs_path"]) for f in to_upd]
+        _upload(kernel, args, jobs)
 
     print(Style.reset, end="")
 
 
+def _ancestors(path):
+    # "a/b/c" -> "a/b", "a"
+    while (n := path.rfind("/")) > 0:
+        path = path[:n]
+        yield path
+
+
+def _upload(kernel: MpKernel, args, jobs):
+    """Upload (path, abs_path) jobs; abs_path is None for directories.
+    Files are read on a background thread while the previous one is sent."""
+    if args.dry_run:
+        for f, _ in jobs:
+            print(f"  {f}")
+        return
+    batch, batch_size = [], 0
+    for f, data in _read_ahead(jobs):
+        print(f"  {f}")
+        if data is None:
+            continue
+        dst = os.path.join(args.remote_path, f)
+        if len(data) < SMALL_FILE_SIZE:
+            literal = repr(data)
+            if len(literal) <= BATCH_SIZE:
+                if batch_size + len(literal) > BATCH_SIZE:
+                    fput_batch(kernel, batch)
+                    batch, batch_size = [], 0
+                batch.append((dst, literal))
+                batch_size += len(literal)
+                continue
+        fput_bytes(kernel, dst, data)
+    if batch:
+        fput_batch(kernel, batch)
+
+
+def _read_ahead(jobs, maxsize=4):
+    # bounded queue caps the number of file bodies held in memory
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer went away, rather than block forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        for f, abs_path in jobs:
+            data = None
+            if abs_path is not None:
+                try:
+                    with open(os.path.join(abs_path, f), "rb") as fp:
+                        data = fp.read()
+                except OSError as e:
+                    data = e
+            if not put((f, data)):
+                return
+        put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while (item := q.get()) is not None:
+            if isinstance(item[1], OSError):
+                raise item[1]
+            yield item
+    finally:
+        stop.set()
+
+
 class FileList:
     def __init__(
         self,
@@ -198,6 +294,7 @@ class FileList:
         include: list[str],
         exclude: list[str],
         kernel: MpKernel,
+        crc: bool = False,
     ):
         # default directory paths
         if len(path) == 0:
@@ -205,61 +302,136 @@ class FileList:
                 path = os.getenv("MP_LOCAL_PATH", "./local").split(":")
             else:
                 path = os.getenv("MP_REMOTE_PATH", "/").split(":")
+        inc = _compile(include)
+        exc = _compile(exclude)
         # get list of files
         self.files = {}
         for p in path:
-            file_list = local_list(p) if local else remote_list(kernel, p)
-            filtered_list = self.filter(file_list, include, exclude)
-            self.files |= self.as_map(filtered_list, p)
-
-    def filter(self, files, include, exclude):
-        inc = [False] * len(files)
-        for n, f in enumerate(files):
-            if f.startswith("D"):
+            file_list = local_list(p) if local else remote_list(kernel, p, crc)
+            for kind, level, f, mtime, size, crc, mtime_ns in file_list:
+                if f.startswith("/"):
+                    f = f[1:]
                 # always include directories or the display looks weird
-                inc[n] = True
-            path = eval(f.split(",")[2])
-            if path.startswith("/"):
-                path = path[1:]
-            for i in include:
-                if fnmatch(path, i):
-                    inc[n] = True
-            for e in exclude:
-                if fnmatch(path, e):
-                    inc[n] = False
-        return [f for n, f in enumerate(files) if inc[n]]
-
-    def as_map(self, files, abs_path):
-        map = {}
-        for f in files:
-            kind, level, path, mtime, size = f.split(",")
-            path = eval(path)
-            if path.startswith("/"):
-                path = path[1:]
-            map[path] = {
-                "is_dir": kind == "D",
-                "level": int(level),
-                "mtime": float(mtime),
-                "size": int(size),
-                "abs_path": abs_path,
-            }
-        return map
-
-
-def local_list(path, files=None, level=-1, full_path=""):
-    if files is None:
-        files = []
-    stat = os.stat(path)
-    fsize = stat[6]
-    mtime = stat[7]
-    if stat[0] & 0x4000:
-        up = os.getcwd()
-        os.chdir(path)
-        if level >= 0:
-            files.append(f"D,{level},{repr(full_path)},{mtime},0")
-        for p in sorted(os.listdir()):
-            local_list(p, files, level + 1, full_path + "/" + p)
-        os.chdir(up)
-    else:
-        files.append(f"F,{level},{repr(full_path)},{mtime},{fsize}")
-    return files
+                if kind != "D" and not inc(f):
+                    continue
+                if exc(f):
+                    continue
+                self.files[f] = {
+                    "is_dir": kind == "D",
+                    "level": level,
+                    "mtime": mtime,
+                    "size": size,
+                    "crc": crc,
+                    "mtime_ns": mtime_ns,
+                    "abs_path": p,
+                }
+
+
+class CrcCache:
+    """CRC32 of local files, persisted across runs and keyed by (size, mtime_ns).
+    Kept in the user's cache directory, outside of any synced tree."""
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_dir = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+            path = os.path.join(cache_dir, "mpkernel", "crc.json")
+        self.path = path
+        self.dirty = False
+        try:
+            with open(path) as f:
+                self.cache = json.load(f)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def crc(self, path, param):
+        key = os.path.abspath(path)
+        entry = self.cache.get(key)
+        if entry and entry[0] == param["size"] and entry[1] == param["mtime_ns"]:
+            return entry[2]
+        with open(path, "rb") as f:
+            crc = zlib.crc32(f.read()) & 0xFFFFFFFF
+        self.cache[key] = [param["size"], param["mtime_ns"], crc]
+        self.dirty = True
+        return crc
+
+    def save(self):
+        if not self.dirty:
+            return
+        # forget files that no longer exist
+        self.cache = {k: v for k, v in self.cache.items() if os.path.exists(k)}
+        # write a temporary file and rename it, so that concurrent kernels or a
+        # crash never leave a partially written cache behind
+        try:
+            cache_dir = os.path.dirname(self.path)
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self.cache, f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError:
+            pass
+
+
+_EXT_PATTERN = re.compile(r"\*\.[A-Za-z0-9]+")
+
+
+def _compile(patterns):
+    """Fuse fnmatch patterns into a single matcher function.
+    Extension-only patterns (*.py) become a set lookup instead of a regex.
+    Like fnmatch.fnmatch, patterns and paths are normcase'd (e.g. on Windows)."""
+    matcher = _compile_normalized([os.path.normcase(p) for p in patterns])
+    if os.path.normcase("A/") == "A/":
+        return matcher
+    return lambda path: matcher(os.path.normcase(path))
+
+
+def _compile_normalized(patterns):
+    if "*" in patterns:
+        return lambda path: True
+    exts = {p[2:] for p in patterns if _EXT_PATTERN.fullmatch(p)}
+    rest = [p for p in patterns if not _EXT_PATTERN.fullmatch(p)]
+    if rest:
+        regex = re.compile("|".join(fnmatch.translate(p) for p in rest)).match
+    if not exts:
+        return regex if rest else lambda path: False
+
+    def ext_match(path):
+        dot = path.rfind(".")
+        return dot >= 0 and path[dot + 1 :] in exts
+
+    if not rest:
+        return ext_match
+    return lambda path: ext_match(path) or regex(path) is not None
+
+
+def local_list(path):
+    """Walk path on host, yielding (kind, level, path, mtime, size, crc, mtime_ns)
+    tuples in the same (sorted, depth-first) order as the remote walker.
+    crc is always None, local CRCs are computed on demand by CrcCache."""
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        yield ("F", -1, "", int(st.st_mtime), st.st_size, None, st.st_mtime_ns)
+        return
+    stack = [(_scandir(path), 0, "")]
+    while stack:
+        it, level, full_path = stack[-1]
+        e = next(it, None)
+        if e is None:
+            stack.pop()
+            continue
+        st = e.stat()
+        f = full_path + "/" + e.name
+        if e.is_dir():
+            yield ("D", level, f, int(st.st_mtime), 0, None, st.st_mtime_ns)
+            stack.append((_scandir(e.path), level + 1, f))
+        else:
+            yield ("F", level, f, int(st.st_mtime), st.st_size, None, st.st_mtime_ns)
+
+
+def _scandir(path):
+    with os.scandir(path) as it:
+        return iter(sorted(it, key=lambda e: e.name))
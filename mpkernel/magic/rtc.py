@@ -21,11 +21,11 @@ def rtc_magic(kernel: MpKernel, args):
     # Note: use localtime since many micropython ports don't use UNIX epoch
     buf = BytesIO()
     kernel.exec_remote(
-        "import time; print(tuple(time.localtime()), end='')",
+        "import time; print(','.join(str(x) for x in time.localtime()), end='')",
         data_consumer=buf.write,
     )
-    t = buf.getvalue().decode()
-    t = eval(t.replace("\x04", ""))
+    t = buf.getvalue().decode().replace("\x04", "")
+    t = tuple(int(x) for x in t.split(","))
     if len(t) < 9:
         t += (-1,)
     t = time.strftime("%Y-%b-%d %H:%M:%S", time.localtime(time.mktime(t)))
@@ -1,10 +1,19 @@
+import codecs
 import os
+import selectors
 from subprocess import PIPE, STDOUT, Popen
 
 from ..kernel import MpKernel
 from . import arg, cell_magic, line_magic
 
 
+@arg(
+    "-c",
+    "--chunk-size",
+    type=int,
+    default=64 * 1024,
+    help="Maximum bytes forwarded per read. Default: 65536.",
+)
 @arg("-s", "--shell", help="Shell to use", default="/bin/bash")
 @cell_magic
 def shell_magic(kernel: MpKernel, args, code):
@@ -21,9 +30,30 @@ def shell_magic(kernel: MpKernel, args, code):
         shell=True,
         close_fds=True,
         executable=args.shell,
+        bufsize=0,
     ) as process:
-        for line in iter(process.stdout.readline, b""):  # type: ignore
-            print(line.rstrip().decode("utf-8"))
+        _forward(process.stdout, args.chunk_size)
+
+
+def _forward(stream, chunk_size):
+    """Print output from stream as it arrives, without waiting for newlines."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    if os.name == "nt":
+        # select does not support pipes on Windows
+        while data := stream.read(chunk_size):
+            print(decoder.decode(data), end="")
+    else:
+        fd = stream.fileno()
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                # sleep until data (or EOF) is available, then read what is there
+                sel.select()
+                data = os.read(fd, chunk_size)
+                if not data:
+                    break
+                print(decoder.decode(data), end="")
+    print(decoder.decode(b"", final=True), end="")
 
 
 @arg("local_path", help="Change local (host) working directory.")
@@ -18,5 +18,16 @@ def writefile(kernel: MpKernel, args, code):
     path = os.path.expanduser(args.path)
     path = os.path.expandvars(path)
     print(f"Writing {path}")
-    with open(path, "a" if args.append else "w") as f:
-        f.write(code)
+    data = code.encode("utf-8")
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    flags |= os.O_APPEND if args.append else os.O_TRUNC
+    fd = os.open(path, flags, 0o644)
+    try:
+        if len(data) > 1 << 20 and not args.append and hasattr(os, "posix_fallocate"):
+            # reserve space for large cells up front
+            os.posix_fallocate(fd, 0, len(data))
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
@@ -1,5 +1,5 @@
+import ast
 import os
-from io import BytesIO
 
 from .kernel import MpKernel
 
@@ -9,30 +9,95 @@ def rm_rf(kernel: MpKernel, path: str, r: bool = True, f: bool = True):
     kernel.exec_remote(f"{_rm_rf_func}\nrm_rf({repr(path)}, {r}, {f})")
 
 
+def rm_rf_batch(
+    kernel: MpKernel, paths, r: bool = True, f: bool = True, batch_size=16 * 1024
+):
+    """rm -rf each of paths, batching calls into scripts of about batch_size bytes"""
+    calls = []
+    size = 0
+    for path in paths:
+        # a failure must not keep the remaining paths from being deleted
+        call = (
+            f"try:\n    rm_rf({repr(path)}, {r}, {f})\n"
+            f"except OSError as _e:\n    print({repr(f'rm {path}:')}, _e)"
+        )
+        if calls and size + len(call) > batch_size:
+            kernel.exec_remote(_rm_rf_func + "\n" + "\n".join(calls))
+            calls, size = [], 0
+        calls.append(call)
+        size += len(call) + 1
+    if calls:
+        kernel.exec_remote(_rm_rf_func + "\n" + "\n".join(calls))
+
+
 def makedirs(kernel: MpKernel, path: str):
     """makedirs path"""
     kernel.exec_remote(f"{_makedirs_func}\nmakedirs({repr(path)})")
 
 
 def fput(kernel: MpKernel, local_path: str, remote_path: str, chunk_size=256):
+    with open(local_path, "rb") as f:
+        data = f.read()
+    fput_bytes(kernel, remote_path, data, chunk_size)
+
+
+def fput_bytes(kernel: MpKernel, remote_path: str, data: bytes, chunk_size=256):
+    """Write data to remote_path, creating parent directories as needed."""
     makedirs(kernel, os.path.dirname(remote_path))
     kernel.exec_remote(f"_f=open('{remote_path}','wb');_w=_f.write")
-    with open(local_path, "rb") as f:
-        while True:
-            data = f.read(chunk_size)
-            if not data:
-                break
-            kernel.exec_remote(f"_w({repr(data)})")
+    for i in range(0, len(data), chunk_size):
+        kernel.exec_remote(f"_w({repr(data[i:i + chunk_size])})")
     kernel.exec_remote("_f.close()")
 
 
-def remote_list(kernel: MpKernel, path):
-    buf = BytesIO()
+def fput_batch(kernel: MpKernel, files):
+    """Write a list of (remote_path, literal) in a single round-trip, where
+    literal is repr(data) (callers typically need its length for budgeting).
+    Intended for small files: the whole script is held in device RAM."""
+    script = [_makedirs_func]
+    for remote_path, literal in files:
+        # a failure (e.g. ENOSPC) must not keep the other files from being written
+        script.append("try:")
+        script.append(f"    makedirs({repr(os.path.dirname(remote_path))})")
+        script.append(f"    with open({repr(remote_path)},'wb') as _f:")
+        script.append(f"        _f.write({literal})")
+        script.append("except OSError as _e:")
+        script.append(f"    print({repr(f'write {remote_path}:')}, _e)")
+    kernel.exec_remote("\n".join(script), wait=False)
+
+
+def remote_list(kernel: MpKernel, path, crc: bool = False):
+    """List path on remote. Walks the entire tree in a single round-trip.
+    Returns a list of (kind, level, path, mtime, size, crc, mtime_ns) tuples,
+    mtime_ns is always None (it is only known on the host).
+    crc is None unless requested, and for directories, files of CRC_MAX_SIZE
+    bytes or more, and on ports without binascii.crc32."""
+    buf = bytearray()
     kernel.exec_remote(
-        _list_files.replace("__PATH__", repr(path)), data_consumer=buf.write
+        _REMOTE_WALK.format(root=repr(path), crc_max=CRC_MAX_SIZE if crc else 0),
+        data_consumer=buf.extend,
     )
-    buf = buf.getvalue().decode().replace("\x04", "").strip()
-    return buf.split("\r\n")
+    files = []
+    for line in buf.decode().replace("\x04", "").strip().splitlines():
+        # path is repr'd and may contain commas: split from both ends
+        kind, level, rest = line.split(",", 2)
+        path, mtime, size, crc = rest.rsplit(",", 3)
+        files.append(
+            (
+                kind,
+                int(level),
+                ast.literal_eval(path),
+                float(mtime),
+                int(size),
+                int(crc, 16) if crc else None,
+                None,
+            )
+        )
+    return files
+
+
+# files smaller than this are compared by CRC32 rather than mtime
+CRC_MAX_SIZE = 64 * 1024
 
 
 # micropython/lib/shared/timeutils/timeutils.h
@@ -40,26 +105,45 @@ def remote_list(kernel: MpKernel, path):
 # time.mktime((2000,1,1,0,0,0,0,0,0)) - time.mktime((1970,1,1,0,0,0,0,0,0))
 # define TIMEUTILS_SECONDS_1970_TO_2000 (946684800ULL)
 
-_list_files = """
+_REMOTE_WALK = """
 import os, time
-EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
-
-def _list(path, level=-1, full_path=""):
-    stat = os.stat(path)
-    fsize = stat[6]
-    mtime = stat[7] + EPOCH_OFFSET
-    if stat[0] & 0x4000:
-        up = os.getcwd()
-        os.chdir(path)
-        if level >= 0:
-            print(f"D,{level},{repr(full_path)},{mtime},0")
-        for p in sorted(os.listdir()):
-            _list(p, level + 1, full_path + "/" + p)
-        os.chdir(up)
-    else:
-        print(f"F,{level},{repr(full_path)},{mtime},{fsize}")
-
-_list(__PATH__)
+_EPOCH = 946684800 if time.gmtime(0)[0] == 2000 else 0
+try:
+    from binascii import crc32 as _crc32
+except ImportError:
+    _crc32 = None
+
+def _crc(path, size):
+    if _crc32 is None or size >= {crc_max}:
+        return ''
+    _c = 0
+    _b = bytearray(512)
+    with open(path, 'rb') as _fp:
+        while True:
+            _n = _fp.readinto(_b)
+            if not _n:
+                break
+            _c = _crc32(memoryview(_b)[:_n], _c)
+    return '%x' % (_c & 0xffffffff)
+
+def _walk(path, level, full):
+    for _e in sorted(os.ilistdir(path)):
+        _p = path.rstrip('/') + '/' + _e[0]
+        _f = full + '/' + _e[0]
+        _s = os.stat(_p)
+        if _e[1] & 0x4000:
+            print('D,%d,%r,%d,0,' % (level, _f, _s[7] + _EPOCH))
+            _walk(_p, level + 1, _f)
+        else:
+            _c = _crc(_p, _s[6])
+            print('F,%d,%r,%d,%d,%s' % (level, _f, _s[7] + _EPOCH, _s[6], _c))
+
+_s = os.stat({root})
+if _s[0] & 0x4000:
+    _walk({root}, 0, '')
+else:
+    _c = _crc({root}, _s[6])
+    print('F,-1,%r,%d,%d,%s' % ('', _s[7] + _EPOCH, _s[6], _c))
 """
 
 _makedirs_func = """
@@ -0,0 +1,60 @@
+import fnmatch
+import ntpath
+import os
+import unittest
+from unittest import mock
+
+from mpkernel.magic.rsync import _compile
+
+PATTERNS = [
+    [],
+    ["*"],
+    ["*.py"],
+    ["*.py", "*.mpy"],
+    ["*.P?"],
+    ["*.py", "lib/*"],
+    ["*.py", "boot*"],
+    ["boot.py"],
+    ["*.[mM]py"],
+]
+
+PATHS = [
+    "py",
+    ".py",
+    "x.py",
+    "X.PY",
+    "a/b.py",
+    "x.py/y",
+    "x.mpy",
+    "x.Mpy",
+    "a.P1",
+    "a.p1",
+    "boot.py",
+    "lib/boot.txt",
+    "LIB/Boot.TXT",
+    "x.tar.gz",
+]
+
+
+class TestCompile(unittest.TestCase):
+    """_compile must agree with fnmatch.fnmatch for every pattern list."""
+
+    def check(self):
+        for patterns in PATTERNS:
+            match = _compile(patterns)
+            for path in PATHS:
+                with self.subTest(patterns=patterns, path=path):
+                    expected = any(fnmatch.fnmatch(path, p) for p in patterns)
+                    self.assertEqual(bool(match(path)), expected)
+
+    def test_host(self):
+        self.check()
+
+    def test_windows(self):
+        # ntpath.normcase lowercases and converts / to \
+        with mock.patch.object(os, "path", ntpath):
+            self.check()
+
+
+if __name__ == "__main__":
+    unittest.main()